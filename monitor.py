@@ -1,22 +1,27 @@
 #!/usr/bin/env python3
 import argparse
-import json
+import asyncio
+import heapq
 import logging
 import os
+import signal
 import sys
-import time
-from collections import defaultdict, deque
-from datetime import datetime
-from threading import Lock
+from array import array
+from functools import lru_cache
+from itertools import zip_longest
+from operator import itemgetter
+from time import monotonic, strftime
 
 import paho.mqtt.client as mqtt
 
-# Setup logging
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=[logging.StreamHandler(sys.stdout)],
-)
+
+class ReportLogHandler(logging.StreamHandler):
+    # Log lines land on top of the report, so force a full redraw next tick
+    def emit(self, record):
+        super().emit(record)
+        invalidate_frame()
+
+
 logger = logging.getLogger(__name__)
 
 # Argument Parsing
@@ -43,229 +48,484 @@ parser.add_argument(
 parser.add_argument(
     "--detail", type=int, default=1, help="Topic depth to show (default: 1)"
 )
-args = parser.parse_args()
+parser.add_argument(
+    "--max-devices",
+    type=int,
+    default=4096,
+    help="Max devices/topics to track; at the cap the least recently seen "
+    "1/64 are dropped (default: 4096)",
+)
+
+# Whether stdout is a terminal; set in main()
+IS_TTY = True
 
 
 # Stats tracking
 class TrafficHistory:
     def __init__(self, max_seconds=900):
         self.max_seconds = max_seconds
-        self.history = deque()  # Entries: [ts_int, msgs, bytes]
-        self.lock = Lock()
+        # Ring buffer indexed by ts_int % size, stored as parallel columns:
+        # the second each slot holds and the cumulative totals as of its end
+        self.size = max_seconds + 1
+        self.ts = array("q", [-1]) * self.size
+        self.cum_msgs = array("q", [0]) * self.size
+        self.cum_bytes = array("q", [0]) * self.size
+        self.first_ts = None
+        self.last_ts = None
+        self.total_msgs = 0
+        self.total_bytes = 0
 
     def add(self, ts, size):
-        with self.lock:
-            ts_int = int(ts)
-            if self.history and self.history[-1][0] == ts_int:
-                self.history[-1][1] += 1
-                self.history[-1][2] += size
+        ts_int = int(ts)
+        if self.last_ts is None or ts_int > self.last_ts:
+            if self.last_ts is None:
+                self.first_ts = start = ts_int
             else:
-                self.history.append([ts_int, 1, size])
-            self._prune(ts_int)
-
-    def _prune(self, now_int):
-        cutoff = now_int - self.max_seconds
-        while self.history and self.history[0][0] < cutoff:
-            self.history.popleft()
+                # Close out the previous second and carry the running totals
+                # through any idle seconds so every slot in the window holds
+                # the cumulative value as of its ts.
+                start = max(self.last_ts, ts_int - self.max_seconds)
+            for t in range(start, ts_int + 1):
+                i = t % self.size
+                self.ts[i] = t
+                self.cum_msgs[i] = self.total_msgs
+                self.cum_bytes[i] = self.total_bytes
+            self.last_ts = ts_int
+
+        self.total_msgs += 1
+        self.total_bytes += size
+
+    def _cumulative_at(self, ts_int):
+        if self.last_ts is None or ts_int < self.first_ts:
+            return 0, 0
+        if ts_int >= self.last_ts:
+            return self.total_msgs, self.total_bytes
+        i = ts_int % self.size
+        if self.ts[i] != ts_int:
+            return 0, 0
+        return self.cum_msgs[i], self.cum_bytes[i]
 
     def get_rates(self, now, intervals=[60, 300, 900]):
-        with self.lock:
-            now_int = int(now)
-            self._prune(now_int)
-            results = []
-            for seconds in intervals:
-                cutoff = now_int - seconds
-                msgs = sum(h[1] for h in self.history if h[0] > cutoff)
-                bytes = sum(h[2] for h in self.history if h[0] > cutoff)
-                results.append((msgs / seconds, bytes / seconds))
-            return results
-
-
-stats_lock = Lock()
-topic_stats = defaultdict(lambda: {"count": 0, "bytes": 0, "last_seen": 0})
+        now_int = int(now)
+        results = []
+        for seconds in intervals:
+            msgs_then, bytes_then = self._cumulative_at(now_int - seconds)
+            msgs = self.total_msgs - msgs_then
+            bytes = self.total_bytes - bytes_then
+            results.append((msgs / seconds, bytes / seconds))
+        return results
+
+
+class TopicStats:
+    """Per-device counters stored column-wise; idx maps device -> row."""
+
+    __slots__ = ("idx", "counts", "bytes_", "last_seen", "max_devices")
+
+    def __init__(self, max_devices=4096):
+        self.idx = {}
+        self.counts = array("q")
+        self.bytes_ = array("q")
+        self.last_seen = array("d")
+        self.max_devices = max_devices
+
+    def add(self, device):
+        if len(self.counts) >= self.max_devices:
+            # Evict a small batch (1/64 of the cap) so the O(n) compaction
+            # is amortised without dropping recently seen devices
+            self.evict(max(self.max_devices // 64, 1))
+        i = self.idx[device] = len(self.counts)
+        self.counts.append(0)
+        self.bytes_.append(0)
+        self.last_seen.append(0)
+        return i
+
+    def evict(self, n):
+        # Drop the n least recently seen devices and compact the columns
+        stale = set(
+            heapq.nsmallest(n, range(len(self.counts)), key=self.last_seen.__getitem__)
+        )
+        keep = [i for i in range(len(self.counts)) if i not in stale]
+        names = list(self.idx)
+        self.idx = {names[i]: row for row, i in enumerate(keep)}
+        self.counts = array("q", [self.counts[i] for i in keep])
+        self.bytes_ = array("q", [self.bytes_[i] for i in keep])
+        self.last_seen = array("d", [self.last_seen[i] for i in keep])
+
+    def snapshot(self):
+        # Rows are only appended or compacted in order, so idx's insertion
+        # order matches the row order
+        return list(zip(self.idx, self.counts, self.bytes_, self.last_seen))
+
+
+topic_stats = TopicStats()
 total_messages = 0
 total_bytes = 0
-start_time = time.time()
+# Timestamps use the monotonic clock; wall time is only needed for the header
+start_time = monotonic()
 traffic_history = TrafficHistory()
 
 
+# Report rendering
+CLEAR_SCREEN = "\x1b[H\x1b[2J"
+ROW_FORMAT = "{d:<40.40} | {c:<10} | {s:<12} | {a}"
+ROW_HEADER = ROW_FORMAT.format(
+    d="Device/Topic", c="Messages", s="Data Volume", a="Last Seen"
+)
+
+
 def on_connect(client, userdata, flags, rc, properties=None):
     if rc == 0:
-        logger.info(f"Connected to MQTT broker at {args.host}")
-        sub_topic = f"{args.base_topic}/#"
+        logger.info(f"Connected to MQTT broker at {userdata.host}")
+        sub_topic = f"{userdata.base_topic}/#"
         client.subscribe(sub_topic)
         logger.info(f"Subscribed to {sub_topic}")
     else:
         logger.error(f"Failed to connect, return code {rc}")
 
 
-def on_message(client, userdata, msg):
-    global total_messages, total_bytes
-    topic = msg.topic
-
-    if args.ignore_bridge and f"{args.base_topic}/bridge" in topic:
-        return
-
+def make_device_of(detail):
     # Extract device name based on detail level
-    parts = topic.split("/")
     # Detail level 1: bridge, my_device
     # Detail level 2: bridge/logging, bridge/state, my_device/availability
-    depth = min(len(parts), args.detail + 1)
-    device = "/".join(parts[1:depth])
-    if not device:
-        device = topic
+    # Slices the topic between the first and (detail + 1)th "/" rather than
+    # splitting it into a list and joining it back together.
+    if detail == 1:
+        # The default level only needs the slice between the first two "/"
+        def device_of(topic):
+            start = topic.find("/") + 1
+            if not start:
+                return topic
+            end = topic.find("/", start)
+            device = topic[start:end] if end >= 0 else topic[start:]
+            return device or topic
 
-    payload_size = len(msg.payload)
-    now = time.time()
+    else:
+
+        def device_of(topic):
+            start = topic.find("/") + 1
+            if not start:
+                return topic
+            end = start - 1
+            for _ in range(detail):
+                end = topic.find("/", end + 1)
+                if end < 0:
+                    return topic[start:] or topic
+            return topic[start:end] or topic
+
+    # Topics repeat constantly, so cache topic -> device name. Repeat hits
+    # return the same string object (with its hash already cached), which
+    # keeps the stats lookup cheap and avoids re-slicing the topic.
+    return lru_cache(maxsize=10000)(device_of)
+
+
+def make_on_message(detail, ignore_bridge, bridge_prefix):
+    # Build the message handler with the configuration baked in; hot names are
+    # bound as defaults so they are local lookups in the callback
+    def on_message(
+        client,
+        userdata,
+        msg,
+        device_of=make_device_of(detail),
+        topic_stats=topic_stats,
+        monotonic=monotonic,
+        history_add=traffic_history.add,
+    ):
+        global total_messages, total_bytes
+        topic = msg.topic
+
+        if ignore_bridge and topic.startswith(bridge_prefix):
+            return
+
+        device = device_of(topic)
+
+        payload_size = len(msg.payload)
+        # Only the size is needed; dropping the payload lets it be freed a
+        # little before paho releases the message after this callback
+        msg.payload = b""
+        now = monotonic()
 
-    with stats_lock:
         total_messages += 1
         total_bytes += payload_size
-        topic_stats[device]["count"] += 1
-        topic_stats[device]["bytes"] += payload_size
-        topic_stats[device]["last_seen"] = now
+        i = topic_stats.idx.get(device)
+        if i is None:
+            i = topic_stats.add(device)
+        topic_stats.counts[i] += 1
+        topic_stats.bytes_[i] += payload_size
+        topic_stats.last_seen[i] = now
+
+        history_add(now, payload_size)
+
+    return on_message
 
-    traffic_history.add(now, payload_size)
+
+BYTE_UNITS = ("B", "KB", "MB", "GB")
+# Bits use 1000 as divisor
+BIT_UNITS = ((1_000_000, "Mbps"), (1_000, "kbps"))
+
+
+def byte_unit_index(value, max_index):
+    # Each 1024x unit step is 10 bits, so the bit length picks the unit
+    return min((max(int(value), 1).bit_length() - 1) // 10, max_index)
 
 
 def format_bytes(size):
-    temp_size = size
-    for unit in ["B", "KB", "MB"]:
-        if temp_size < 1024:
-            return f"{temp_size:7.2f} {unit}"
-        temp_size /= 1024
-    return f"{temp_size:7.2f} GB"
+    i = byte_unit_index(size, 3)
+    return f"{size / (1 << 10 * i):7.2f} {BYTE_UNITS[i]}"
 
 
 def format_rate(bytes_per_sec):
-    # Byte rate (KB/s)
-    temp_bytes = bytes_per_sec
-    byte_unit = "B/s"
-    if temp_bytes >= 1024:
-        temp_bytes /= 1024
-        byte_unit = "KB/s"
-    if temp_bytes >= 1024:
-        temp_bytes /= 1024
-        byte_unit = "MB/s"
-
-    # Bit rate (kbps) - bits use 1000 as divisor
-    temp_bits = bytes_per_sec * 8
-    bit_unit = "bps"
-    if temp_bits >= 1000:
-        temp_bits /= 1000
-        bit_unit = "kbps"
-    if temp_bits >= 1000:
-        temp_bits /= 1000
-        bit_unit = "Mbps"
-
-    return f"{temp_bytes:7.2f} {byte_unit} ({temp_bits:7.2f} {bit_unit})"
-
-
-def format_rate_short(bytes_per_sec):
-    temp_bytes = bytes_per_sec
-    byte_unit = "B/s"
-    if temp_bytes >= 1024:
-        temp_bytes /= 1024
-        byte_unit = "KB/s"
-    if temp_bytes >= 1024:
-        temp_bytes /= 1024
-        byte_unit = "MB/s"
-    return f"{temp_bytes:0.2f} {byte_unit}"
-
-
-def format_bit_rate(bytes_per_sec):
-    temp_bits = bytes_per_sec * 8
-    bit_unit = "bps"
-    if temp_bits >= 1000:
-        temp_bits /= 1000
-        bit_unit = "kbps"
-    if temp_bits >= 1000:
-        temp_bits /= 1000
-        bit_unit = "Mbps"
-    return f"{temp_bits:0.2f} {bit_unit}"
+    """Return the (byte rate, bit rate) strings, e.g. ("1.50 KB/s", "12.29 kbps")."""
+    i = byte_unit_index(bytes_per_sec, 2)
+    byte_rate = f"{bytes_per_sec / (1 << 10 * i):0.2f} {BYTE_UNITS[i]}/s"
+
+    bits = bytes_per_sec * 8
+    for divisor, unit in BIT_UNITS:
+        if bits >= divisor:
+            return byte_rate, f"{bits / divisor:0.2f} {unit}"
+    return byte_rate, f"{bits:0.2f} bps"
+
+
+# Terminal size (and the ruler sized to it) is cached and only re-queried
+# after a SIGWINCH, where the platform has one
+HAS_SIGWINCH = hasattr(signal, "SIGWINCH")
+terminal_size = None
+ruler = ""
+
+# Screen rows of the last frame; only rows that differ get redrawn
+prev_rows = []
+
+
+def get_terminal_size():
+    global terminal_size, ruler
+    # Without SIGWINCH (e.g. Windows) there is no resize notification, so
+    # re-query on every report
+    if terminal_size is None or not HAS_SIGWINCH:
+        try:
+            size = tuple(os.get_terminal_size())
+        except OSError:
+            size = (80, 24)
+        # Some PTYs (docker -t before a resize, serial consoles) report 0x0
+        if size[0] < 1 or size[1] < 1:
+            size = (80, 24)
+        if size != terminal_size:
+            terminal_size = size
+            ruler = "-" * size[0]
+            invalidate_frame()
+    return terminal_size
+
+
+def invalidate_frame():
+    global prev_rows
+    prev_rows = []
+
+
+def on_resize(signum, frame):
+    global terminal_size
+    terminal_size = None
+    invalidate_frame()
+
+
+def render_frame(out, columns, lines):
+    global prev_rows
+    # Wrap lines into screen rows ourselves so row positions are exact
+    rows = []
+    for line in out:
+        rows.extend(
+            [line[i : i + columns] for i in range(0, len(line), columns)] or [""]
+        )
+    del rows[max(lines - 1, 1) :]
 
+    buf = [] if prev_rows else [CLEAR_SCREEN]
+    for i, (old, new) in enumerate(zip_longest(prev_rows, rows)):
+        if old != new:
+            buf.append(f"\x1b[{i + 1};1H\x1b[2K{new or ''}")
+    # Park the cursor below the frame
+    buf.append(f"\x1b[{len(rows) + 1};1H")
+    prev_rows = rows
 
-def print_report():
-    os.system("clear")
-    now = time.time()
-    elapsed = now - start_time
+    sys.stdout.write("".join(buf))
+    sys.stdout.flush()
 
-    # Get terminal size
-    try:
-        columns, lines = os.get_terminal_size()
-    except OSError:
-        columns, lines = 80, 24
 
-    with stats_lock:
-        current_stats = list(topic_stats.items())
-        mps = total_messages / elapsed
-        bps = total_bytes / elapsed
-        total_msg = total_messages
-        total_sz = total_bytes
+def print_report():
+    now = monotonic()
+    elapsed = now - start_time
+    mps = total_messages / elapsed
+    bps = total_bytes / elapsed
 
     # Get history rates
     rates = traffic_history.get_rates(now)
-    msg_rates = ", ".join([f"{r[0]:0.2f}" for r in rates])
-    byte_rates = ", ".join([format_rate_short(r[1]) for r in rates])
-    bit_rates = ", ".join([format_bit_rate(r[1]) for r in rates])
 
-    # Sort by message count descending
-    current_stats.sort(key=lambda x: x[1]["count"], reverse=True)
+    # Not a terminal (piped, systemd, docker): log one summary line instead
+    if not IS_TTY:
+        logger.info(
+            "msgs=%d bytes=%d devices=%d mps=%.2f bps=%.2f mps_1m=%.2f bps_1m=%.2f",
+            total_messages,
+            total_bytes,
+            len(topic_stats.idx),
+            mps,
+            bps,
+            rates[0][0],
+            rates[0][1],
+        )
+        return
 
-    print(
-        f"Zigbee2MQTT Network Monitor - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
-    )
-    print(f"Messages:  {msg_rates} /s")
-    print(f"Data:      {byte_rates}")
-    print(f"Bitrate:   {bit_rates}")
-    print(
-        f"Total: {total_msg} msgs ({mps:0.2f}/s avg) | {format_bytes(total_sz)} ({format_rate_short(bps)} avg) | Elapsed: {elapsed:0.1f}s"
-    )
-    print("-" * columns)
-    print(
-        f"{'Device/Topic':<40} | {'Messages':<10} | {'Data Volume':<12} | {'Last Seen'}"
-    )
-    print("-" * columns)
+    columns, lines = get_terminal_size()
+    current_stats = topic_stats.snapshot()
+    msg_rates = ", ".join([f"{r[0]:0.2f}" for r in rates])
+    byte_rates, bit_rates = zip(*[format_rate(r[1]) for r in rates])
+    byte_rates = ", ".join(byte_rates)
+    bit_rates = ", ".join(bit_rates)
+
+    out = [
+        f"Zigbee2MQTT Network Monitor - {strftime('%Y-%m-%d %H:%M:%S')}",
+        f"Messages:  {msg_rates} /s",
+        f"Data:      {byte_rates}",
+        f"Bitrate:   {bit_rates}",
+        f"Total: {total_messages} msgs ({mps:0.2f}/s avg) | {format_bytes(total_bytes)} ({format_rate(bps)[0]} avg) | Elapsed: {elapsed:0.1f}s",
+        ruler,
+        ROW_HEADER,
+        ruler,
+    ]
 
     # Calculate how many rows we can fit (headers are 8 lines, footer might be 1)
     max_rows = lines - 9
     if max_rows < 1:
         max_rows = 1
 
-    for device, data in current_stats[:max_rows]:
-        last_seen_str = f"{now - data['last_seen']:0.1f}s ago"
-        print(
-            f"{device[:40]:<40} | {data['count']:<10} | {format_bytes(data['bytes']):<12} | {last_seen_str}"
+    # Only the rows that fit on screen are needed, so select the top talkers
+    # by message count instead of sorting every device
+    top = heapq.nlargest(max_rows, current_stats, key=itemgetter(1))
+    row_format = ROW_FORMAT.format
+    for device, count, size, last_seen in top:
+        out.append(
+            row_format(
+                d=device,
+                c=count,
+                s=format_bytes(size),
+                a=f"{now - last_seen:0.1f}s ago",
+            )
         )
 
     if not current_stats:
-        print("Waiting for messages...")
+        out.append("Waiting for messages...")
 
+    render_frame(out, columns, lines)
 
-# Client Setup
-try:
-    client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION2)
-except (AttributeError, TypeError):
-    client = mqtt.Client()
 
-client.on_connect = on_connect
-client.on_message = on_message
-
-if args.user and args.password:
-    client.username_pw_set(args.user, args.password)
+async def misc_loop(client):
+    # Keepalive/retry housekeeping, and reconnect since there is no paho thread.
+    # Retries back off like paho's reconnect_delay_set defaults (1s -> 120s).
+    loop = asyncio.get_running_loop()
+    delay = 1
+    retry_at = 0
+    failing = False
+    while True:
+        if client.loop_misc() == mqtt.MQTT_ERR_NO_CONN and monotonic() >= retry_at:
+            try:
+                # The connect blocks on DNS/TCP, so keep it off the loop thread
+                # and let the report keep refreshing during an outage
+                await loop.run_in_executor(None, client.reconnect)
+            except OSError as e:
+                if not failing:
+                    logger.error(f"Reconnect failed: {e}; retrying with backoff")
+                    failing = True
+                retry_at = monotonic() + delay
+                delay = min(delay * 2, 120)
+            else:
+                if failing:
+                    logger.info("Reconnected to MQTT broker")
+                    failing = False
+                delay = 1
+        await asyncio.sleep(1)
+
+
+async def run(client, args):
+    # Drive paho from the asyncio loop instead of loop_start()'s thread, so
+    # message handling and reporting share one thread and need no locks
+    loop = asyncio.get_running_loop()
+
+    def on_loop(fn, *fn_args):
+        # Sockets can be opened from misc_loop's reconnect worker thread, so
+        # hand registration over to the loop when called from there
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            loop.call_soon_threadsafe(fn, *fn_args)
+        else:
+            fn(*fn_args)
+
+    client.on_socket_open = lambda c, u, sock: on_loop(
+        loop.add_reader, sock, c.loop_read
+    )
+    client.on_socket_close = lambda c, u, sock: loop.remove_reader(sock)
+    client.on_socket_register_write = lambda c, u, sock: on_loop(
+        loop.add_writer, sock, c.loop_write
+    )
+    client.on_socket_unregister_write = lambda c, u, sock: loop.remove_writer(sock)
 
-try:
     client.connect(args.host, args.port, 60)
-    client.loop_start()
+    misc = asyncio.create_task(misc_loop(client))
+    try:
+        while True:
+            print_report()
+            await asyncio.sleep(args.interval)
+    finally:
+        misc.cancel()
+        client.disconnect()
+        client.loop_write()
+
+
+def main():
+    global IS_TTY
+    args = parser.parse_args()
+    if args.max_devices < 1:
+        parser.error("--max-devices must be at least 1")
+    IS_TTY = sys.stdout.isatty()
+    topic_stats.max_devices = args.max_devices
+
+    # Setup logging
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s [%(levelname)s] %(message)s",
+        handlers=[ReportLogHandler(sys.stdout)],
+    )
 
-    while True:
-        print_report()
-        time.sleep(args.interval)
-
-except KeyboardInterrupt:
-    print("\nStopping monitor...")
-except Exception as e:
-    logger.error(f"Error: {e}")
-finally:
-    client.loop_stop()
-    client.disconnect()
+    if IS_TTY and HAS_SIGWINCH:
+        signal.signal(signal.SIGWINCH, on_resize)
+
+    # Client Setup
+    try:
+        client = mqtt.Client(
+            callback_api_version=mqtt.CallbackAPIVersion.VERSION2, userdata=args
+        )
+    except (AttributeError, TypeError):
+        client = mqtt.Client(userdata=args)
+
+    client.on_connect = on_connect
+    client.on_message = make_on_message(
+        args.detail, args.ignore_bridge, f"{args.base_topic}/bridge"
+    )
+
+    if args.user and args.password:
+        client.username_pw_set(args.user, args.password)
+
+    # The default Windows (Proactor) loop has no add_reader/add_writer. The
+    # policy API is deprecated from 3.14, so only use it before loop_factory.
+    run_kwargs = {}
+    if sys.platform == "win32":
+        if sys.version_info >= (3, 12):
+            run_kwargs["loop_factory"] = asyncio.SelectorEventLoop
+        else:
+            asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+
+    try:
+        asyncio.run(run(client, args), **run_kwargs)
+    except KeyboardInterrupt:
+        print("\nStopping monitor...")
+    except Exception as e:
+        logger.error(f"Error: {e}")
+
+
+if __name__ == "__main__":
+    main()